@@ -1,10 +1,25 @@
 from __future__ import print_function
 import argparse
-import json
 import datetime
 import logging
+import mmap
+import os
 import sys
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+try:
+    # Optional: streaming JSON parser, avoids loading the whole Simple Note export in memory
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    # Optional: faster JSON parser, used when ijson is not available
+    import orjson
+except ImportError:
+    orjson = None
+    import json
 
 def eprint(*args, **kwargs):
     """
@@ -19,9 +34,82 @@ def eprint(*args, **kwargs):
     """
     print(*args, file=sys.stderr, **kwargs)
 
+def xml_escape(text):
+    """
+    Escape XML special characters &, < and > - used for note title, author and tags
+    (issue #03: joplin chokes importing a note with an ampersand / & in the note title)
+
+    Parameters
+    ----------
+    text : str
+
+    Returns
+    -------
+    str
+        text with & < > replaced by &amp; &lt; &gt;
+    """
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
 # Constants for default or hard-coded parameters
 MAX_TITLE_LEN = 250
-FIX_AMPERSAND_IN_TITLE = True
+# Parallel conversion: notes sent to a worker process at a time, and minimum number of
+# notes to be converted for the process pool to be worth starting.  A note converts in a few
+# microseconds while starting a worker takes several ms (fork) to ~100 ms (spawn), so the
+# pool only pays off for exports with tens of thousands of notes
+NOTES_PER_BATCH = 256
+MIN_NOTES_PARALLEL = 50000
+# Minimum size in bytes of export file to be memory mapped (instead of read) when parsed with orjson
+MIN_MMAP_SIZE = 1024 * 1024
+
+# Constant fragments of the XML for an individual note, assembled by convert_to_enex
+# TODO: verify if the CDATA and DOCTYPE are needed for plain Markdown Notes.
+_NOTE_HEAD = '''
+<note>
+<title>'''
+_NOTE_CDATA_OPEN = '''</title>
+<content>
+    <![CDATA[<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+    <!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
+    <en-note><div>'''
+_NOTE_CDATA_CLOSE = '''</div></en-note>
+    ]]>
+</content>
+'''
+_NOTE_TAIL = '''
+</note>
+'''
+
+# Converter used by _convert_batch in worker processes - set once per worker by _init_worker
+_worker_sne = None
+
+def _init_worker(sne):
+    """
+    Initializer of the worker processes converting notes in parallel:
+    keep the converter (with all conversion options) so it is not sent again with every batch
+
+    Parameters
+    ----------
+    sne : SimpleNoteToEnex
+        converter holding the conversion options
+    """
+    global _worker_sne
+    _worker_sne = sne
+
+def _convert_batch(sn_notes):
+    """
+    Convert a batch of notes to ENEX.  Runs in worker processes, hence a module level function
+
+    Parameters
+    ----------
+    sn_notes : list of dict
+        Simple Note notes to be converted
+
+    Returns
+    -------
+    str
+        ENEX text of all notes in the batch
+    """
+    return ''.join(map(_worker_sne.convert_to_enex, sn_notes))
 
 class SimpleNoteToEnex:
     """
@@ -65,20 +153,32 @@ class SimpleNoteToEnex:
     verbose : bool
         generage verbose output to stderr
         TODO: implement proper logging
+    jobs : int
+        Number of worker processes converting notes.  1 (default) converts in the calling process
 
     Methods
     -------
     convert_to_enex(sn_note)
         Convert an individual Simple Note note in JSON format to ENEX XML
-    process_file()
-        Process all notes in Simple Note export file. Call convert_to_enex for notes allowed by tag_filter
+    process_file(out)
+        Process all notes in Simple Note export file. Call write_notes to convert the active notes
+        The ENEX text is written to out (default sys.stdout) - returns the number of converted notes,
+        no longer the ENEX text as a string
+    load_json()
+        Load the whole Simple Note export file - used when ijson is not available
+    write_notes(sn_notes, out)
+        Call convert_to_enex for notes allowed by tag_filter and write them to out
+    write_notes_parallel(sn_notes, out)
+        Same as write_notes for notes already filtered, converting batches of notes in a process pool
+    select_notes(sn_notes)
+        Yield the notes allowed by tag_filter, up to max_notes
     match_note_logical_or()
         Determine if a given note should be converted based on tag filter or match tagged/untagged flags
 
     """
 
     def __init__(self, json_file, author=None, create_title=False, title_size=MAX_TITLE_LEN, verbose_level=0, max_notes=None, tag_filter='',
-                 invert_match=False, match_tagged=False, match_untagged=False):
+                 invert_match=False, match_tagged=False, match_untagged=False, jobs=1):
         """
 
         Parameters
@@ -93,6 +193,7 @@ class SimpleNoteToEnex:
         invert_match
         match_tagged
         match_untagged
+        jobs
 
         """
         self.author = author
@@ -100,12 +201,9 @@ class SimpleNoteToEnex:
         # Max length -- in case there is no \r\n to delimit the note's first line
         self.max_title_len = title_size if title_size >= 0 else MAX_TITLE_LEN
         self.sn_title_separator = '\r\n'
-        # True if we want to address issue #03 (joplin chokes importing note with ampersand / & in note title)
-        # At the moment hardcoded. 
-        # TODO: Consider using a CLI switch if this fix for joplin impacts import in other note apps.
-        self.fix_ampersand_title = FIX_AMPERSAND_IN_TITLE            
         self.json_file = json_file
-        self.export_time = datetime.datetime.now().strftime("%Y%m%d%H%M%S%ZZ")  # TODO: fix time format (Z)
+        # ENEX format YYYYMMDDThhmmssZ, in UTC
+        self.export_time = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
         self.verbose_level = verbose_level
         self.match_tagged = match_tagged
         self.match_untagged = match_untagged
@@ -113,46 +211,25 @@ class SimpleNoteToEnex:
         if max_notes == None:
             self.max_notes = sys.maxsize
         else:
-            self.max_notes = max_notes
+            # A negative number of notes converts nothing (islice in select_notes requires a stop >= 0)
+            self.max_notes = max(max_notes, 0)
         if tag_filter is None or tag_filter == '':
             self.filter_tags = False
         else:
             self.filter_tags = True
             self.tag_filter = tag_filter.split(',')
+            # Built once, used by match_note_logical_or for every note
+            self._tag_filter_set = frozenset(self.tag_filter)
         self.match_untagged = match_untagged
         self.match_tagged = match_tagged
         self.line_sep = '\r\n'
+        self.jobs = jobs if jobs is not None and jobs > 0 else 1
         if self.verbose_level > 1:
             eprint(f"match_untagged {self.match_untagged}")
             eprint(f"match_tagged {self.match_tagged}")
             eprint(f"filter_tags {self.filter_tags}")
             eprint(f"invert_match {self.invert_match}")
     
-    def cleanup_content(self, json_content, pattern = "\\r\\n", remove_whitespace = True, replace_br = True):
-        """
-        Clean up json_content from simplenotes (or other note provider):
-        - remove leading and trailing whitespace - driven by remove_whitespace Boolean
-        - remove leading and training pattern strings (default '\r\n' -> empty lines) 
-        
-        returns:  "clean" string
-        """
-        if remove_whitespace:
-            # Leading whitespace
-            #temp_string = re.sub("\A\s+", "", json_content)
-            # Trailing whitespace
-            #temp_string = re.sub("\s+\Z", "", temp_string)
-            temp_string = json_content.strip()
-
-        # remove pattern at the start of the string
-        temp_string = re.sub("\A" + pattern, "", temp_string)
-        # remove pattern at the end of the string 
-        temp_string = re.sub(pattern + "\Z", "", temp_string)
-
-        # if replace_br:
-        #     temp_string = re.sub(pattern, "<br/>", temp_string)
-        # return temp_string
-        return temp_string
-
     def embed_extra_codes(self, json_content):
         """
         Modify up json_content from simplenotes (or other note provider):
@@ -182,16 +259,25 @@ class SimpleNoteToEnex:
         str
             full text (XML format) of Simple Note note converted to XML
         """
+        # Attribute used several times per note, bound to a local
+        line_sep = self.line_sep
         # Lambda to simplify verification of parameter and convert None to empty string ''
         verif_none = lambda note_property: note_property or ''
         # Simple Note export formats date as YYYY-MM-DDT:hh:mm:ss.xxxZ
         # ENEX seems to use YYYYMMDDThhmmssZ
         # Perform basic conversion keeping the milliseconds (xxx) anyway
+        # (chained str.replace is faster here than str.translate with a deletion table)
         enex_created = sn_note['creationDate'].replace('-', '').replace(':', '').replace('.', '')
         enex_updated = sn_note['lastModified'].replace('-', '').replace(':', '').replace('.', '')
-        enex_content = verif_none(sn_note['content'])
-        enex_content = self.cleanup_content(enex_content, self.line_sep, True)
-        enex_author = verif_none(self.author)
+        # Clean up content: remove leading and trailing whitespace, then leading and trailing line_sep (empty lines)
+        enex_content = verif_none(sn_note['content']).strip()
+        if line_sep:
+            len_sep = len(line_sep)
+            while enex_content.startswith(line_sep):
+                enex_content = enex_content[len_sep:]
+            while enex_content.endswith(line_sep):
+                enex_content = enex_content[:-len_sep]
+        enex_author = xml_escape(verif_none(self.author))
         enex_source = "Converted from Simple Note (simplenote.com)"
         # enex_latitude = kwargs['latitude']
         # enex_longitude = kwargs['longitude']
@@ -200,55 +286,58 @@ class SimpleNoteToEnex:
         if (self.add_note_title):
             # Simple Note JSON export format does not have explicit field to contain the note title.
             # Assume title is first line of Simple Note content, delimited by first "\r\n"
-            enex_title = enex_content.split(self.sn_title_separator, 1)[0]
-            enex_title = enex_title[:min(len(enex_title), self.max_title_len)]
-            # fix for Joplin specific issue - chokes importing a note with an ampersand in the title
-            # workaround is to encode --in the title-- the & using the html code &amp;
-            if self.fix_ampersand_title:
-                enex_title = re.sub('&', '&amp;', enex_title)
+            # Slice only the title out of the content, truncated to max_title_len
+            title_end = enex_content.find(self.sn_title_separator)
+            if title_end == -1 or title_end > self.max_title_len:
+                title_end = self.max_title_len
+            enex_title = xml_escape(enex_content[:title_end])
         else:
             enex_title = ''
 
         enex_content = self.embed_extra_codes(enex_content)
+        # Content is not escaped as it goes inside CDATA - just make sure it cannot terminate the CDATA section
+        if ']]>' in enex_content:
+            enex_content = enex_content.replace(']]>', ']]]]><![CDATA[>')
 
+        # A plain loop beats ''.join(generator) for the usual 0-3 tags per note
         enex_tags = ''
-        if 'tags' in sn_note:
-            for tag in sn_note['tags']:
-                enex_tags += '<tag>' + tag + '</tag>' + self.line_sep
-        # Build XML output using f-strings
-        # TODO: verify if the CDATA and DOCTYPE are needed for plain Markdown Notes.
-        enex_note = f'''
-<note>
-<title>{enex_title}</title>
-<content>
-    <![CDATA[<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-    <!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
-    <en-note><div>{enex_content}</div></en-note>
-    ]]>
-</content>
-<created>{enex_created}</created>
-<updated>{enex_updated}</updated>
-<note-attributes>
-    <author>{enex_author}</author>
-</note-attributes>
-{enex_tags}
-</note>
-        '''
-        return enex_note + self.line_sep
+        for tag in sn_note.get('tags', ()):
+            enex_tags += f'<tag>{xml_escape(tag)}</tag>{line_sep}'
+        # Build XML output from the constant _NOTE_* fragments, in a single f-string
+        return (f'{_NOTE_HEAD}{enex_title}{_NOTE_CDATA_OPEN}{enex_content}{_NOTE_CDATA_CLOSE}'
+                f'<created>{enex_created}</created>\n'
+                f'<updated>{enex_updated}</updated>\n'
+                '<note-attributes>\n'
+                f'    <author>{enex_author}</author>\n'
+                '</note-attributes>\n'
+                f'{enex_tags}{_NOTE_TAIL}{line_sep}')
 
     #          <source>{enex_source}</source>
     #          <reminder-order>0</reminder-order>
 
-    def process_file(self):
+    def process_file(self, out=None):
         """
         Process JSON file (self.json_file) with Simple Note notes in JSON format
 
+        Each note is written to out as soon as it is converted, so the full ENEX document
+        is never held in memory.
+
+        Parameters
+        ----------
+        out : file object
+            Writable text stream receiving the ENEX (XML) output.  Default (None) is sys.stdout,
+            looked up at call time
+
         Returns
         -------
-        str
-            full text of json_file converted to ENEX format (XML)
+        int
+            number of notes converted to ENEX format.
+            Note: earlier versions returned the full ENEX text as a string; to get it as a string
+            pass an io.StringIO() as out and call its getvalue()
 
         """
+        if out is None:
+            out = sys.stdout
 
         #    </en-export export-date=\"{export_time}\">
         enex_file_header = f'''
@@ -257,27 +346,130 @@ class SimpleNoteToEnex:
 <en-export export-date=\"{self.export_time}\">
 '''
         enex_file_footer = '''</en-export>'''
-        enex_text = ''
-        with open(self.json_file) as jfp:
-            simplenotes = json.load(jfp)
-            num_active_notes = len(simplenotes['activeNotes'])
+        if self.verbose_level >= 1:
+            eprint(f"Processing file: {self.json_file} ")
+            eprint(f"Notes author: ", self.author)
+        if ijson is not None:
+            # Parse active notes one at a time - trashed notes are skipped by the parser
+            with open(self.json_file, 'rb') as jfp:
+                # ijson yields no notes when there is no 'activeNotes' key (e.g. wrong input file):
+                # check for the key before writing anything, as the non streaming path does.
+                # 'activeNotes' is normally the first key of the export so this stops almost immediately
+                if not any(prefix == '' and event == 'map_key' and value == 'activeNotes'
+                           for prefix, event, value in ijson.parse(jfp)):
+                    raise KeyError('activeNotes')
+                jfp.seek(0)
+                out.write(enex_file_header + self.line_sep)
+                nconv = self.write_notes(ijson.items(jfp, 'activeNotes.item'), out)
+        else:
+            simplenotes = self.load_json()
+            active_notes = simplenotes['activeNotes']
             if self.verbose_level >= 1:
-                eprint(f"Processing file: {self.json_file} ")
-                eprint(f"Notes author: ", self.author)
-                eprint(f"Active notes:   {num_active_notes}")
+                eprint(f"Active notes:   {len(active_notes)}")
                 if 'trashedNotes' in simplenotes:
                     eprint(f"Trashed notes:  {len(simplenotes['trashedNotes'])} -- will not be converted to ENEX")
-            nconv = 0
-            number_to_be_converted = min(self.max_notes, num_active_notes)
-            for sn_note in simplenotes['activeNotes']:
-                if nconv >= number_to_be_converted:
-                    break
-                if self.match_note_logical_or(sn_note):
-                    enex_text += self.convert_to_enex(sn_note)
-                    nconv += 1
+            out.write(enex_file_header + self.line_sep)
+            nconv = self.write_notes(active_notes, out)
+        out.write(self.line_sep + enex_file_footer + '\n')
         if self.verbose_level > 0:
             eprint(f"Converted {nconv} notes")
-        return enex_file_header + self.line_sep + enex_text + self.line_sep + enex_file_footer
+        return nconv
+
+    def load_json(self):
+        """
+        Load the whole JSON file (self.json_file) with orjson if available, otherwise with the json module.
+        orjson parses large files directly from a memory map, avoiding a copy of the file in memory.
+
+        Returns
+        -------
+        dict
+            Simple Note export (with 'activeNotes' and 'trashedNotes' lists)
+        """
+        with open(self.json_file, 'rb') as jfp:
+            if orjson is None:
+                return json.loads(jfp.read())
+            if os.fstat(jfp.fileno()).st_size < MIN_MMAP_SIZE:
+                return orjson.loads(jfp.read())
+            with mmap.mmap(jfp.fileno(), 0, access=mmap.ACCESS_READ) as jmm, memoryview(jmm) as jview:
+                return orjson.loads(jview)
+
+    def write_notes(self, sn_notes, out):
+        """
+        Convert to ENEX and write to out the notes allowed by the tag filters, up to self.max_notes
+
+        Parameters
+        ----------
+        sn_notes : iterable of dict
+            Simple Note notes (from 'activeNotes' in the JSON export)
+        out : file object
+            Writable text stream receiving the converted notes
+
+        Returns
+        -------
+        int
+            number of notes converted
+        """
+        selected = self.select_notes(sn_notes)
+        if self.jobs > 1:
+            # Only start the process pool if there are enough notes to be converted
+            first_notes = list(islice(selected, MIN_NOTES_PARALLEL))
+            if len(first_notes) == MIN_NOTES_PARALLEL:
+                return self.write_notes_parallel(chain(first_notes, selected), out)
+            selected = first_notes
+        # Bound methods cached as locals for the per-note loop (match_note_logical_or is bound in select_notes)
+        convert = self.convert_to_enex
+        write = out.write
+        nconv = 0
+        for sn_note in selected:
+            write(convert(sn_note))
+            nconv += 1
+        return nconv
+
+    def write_notes_parallel(self, sn_notes, out):
+        """
+        Convert to ENEX batches of NOTES_PER_BATCH notes in self.jobs worker processes, writing them
+        to out in the original order.  Only a few batches per worker are in flight at any time.
+
+        Parameters
+        ----------
+        sn_notes : iterator of dict
+            Simple Note notes to be converted - already filtered (see select_notes)
+        out : file object
+            Writable text stream receiving the converted notes
+
+        Returns
+        -------
+        int
+            number of notes converted
+        """
+        nconv = 0
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker, initargs=(self,)) as executor:
+            for batch in iter(lambda: list(islice(sn_notes, NOTES_PER_BATCH)), []):
+                if len(pending) >= 2 * self.jobs:
+                    out.write(pending.popleft().result())
+                pending.append(executor.submit(_convert_batch, batch))
+                nconv += len(batch)
+            while pending:
+                out.write(pending.popleft().result())
+        return nconv
+
+    def select_notes(self, sn_notes):
+        """
+        Select the notes allowed by the tag filters (see match_note_logical_or), up to self.max_notes
+
+        Parameters
+        ----------
+        sn_notes : iterable of dict
+            Simple Note notes (from 'activeNotes' in the JSON export)
+
+        Returns
+        -------
+        iterator of dict
+            Simple Note notes to be converted
+        """
+        # max_notes caps the number of converted (i.e. matching) notes, not the number of notes read
+        return islice(filter(self.match_note_logical_or, sn_notes), self.max_notes)
 
     def match_note_logical_or(self, sn_note):
         """
@@ -318,33 +510,42 @@ class SimpleNoteToEnex:
         # if no filter or matching command is applied
         if not(self.filter_tags or self.match_tagged or self.match_untagged):
             return True         # regardless of value of invert_match
-        convert_this_note = False
-        if self.filter_tags and 'tags' in sn_note:
-            # Convert array of tags in filter and array of tags in note into sets.
-            # Match if the intersection of both sets is non-empty.
-            if len(set(self.tag_filter) & (set(sn_note['tags']))) != 0:
-                convert_this_note = True
-        if self.match_untagged and not('tags' in sn_note):
-            convert_this_note = True
-        if self.match_tagged and 'tags' in sn_note:
-            convert_this_note = True
-        # XOR result with invert_match
-        return convert_this_note != self.invert_match
+        # Return as soon as one of the filters matches - result XORed with invert_match
+        has_tags = 'tags' in sn_note
+        if self.match_tagged and has_tags:
+            return not self.invert_match
+        if self.match_untagged and not has_tags:
+            return not self.invert_match
+        # Match if the intersection of the (precomputed) set of tags in filter and the tags in note is non-empty.
+        if self.filter_tags and has_tags and not self._tag_filter_set.isdisjoint(sn_note['tags']):
+            return not self.invert_match
+        return self.invert_match
 
 
 def main(args):
-    # TODO: explicit argument for output file
     sne = SimpleNoteToEnex(args.json_file, args.author, args.create_title, args.title_size, 
                            args.verbose_level, args.num_notes, args.tag_filter, args.invert_match,
-                           args.match_tagged, args.match_untagged )
-    enex_file = sne.process_file()
-    print(enex_file)
+                           args.match_tagged, args.match_untagged, args.jobs)
+    if args.output is None:
+        sne.process_file(sys.stdout)
+    else:
+        # newline='' keeps the '\r\n' line separators unchanged on all platforms
+        try:
+            with open(args.output, 'w', encoding='utf-8', newline='') as out:
+                sne.process_file(out)
+        except BaseException:
+            # do not leave behind an empty or truncated ENEX file
+            if os.path.exists(args.output):
+                os.remove(args.output)
+            raise
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--json-file', required=True, type=str, dest='json_file',
                         help='Simple Note export file (json) to be converted to ENEX')
+    parser.add_argument('--output', required=False, type=str,
+                        help='ENEX file to be created (Optional, default is write to stdout)')
     parser.add_argument('--author', required=False, type=str,
                         help='Specify an author for all converted notes')
     parser.add_argument('--create-title', required=False, dest='create_title', action='store_true',
@@ -363,5 +564,8 @@ if __name__ == '__main__':
                         help=f"Verbose output level. Output to stderr. Default 0 - no output")
     parser.add_argument('--number', required=False, dest='num_notes', type=int,
                         help='Number of notes to convert (Optional, default is convert all notes)')
+    parser.add_argument('--jobs', required=False, dest='jobs', type=int, default=1,
+                        help='Number of processes converting notes in parallel - default 1. '
+                             f'Only used with at least {MIN_NOTES_PARALLEL} notes to convert')
     args = parser.parse_args()
     main(args)